@@ -4,4 +4,16 @@ config.py
 Store configuration details here
 """
 
-PORTFOLIO_STORAGE_DIR = "/Users/ben/portfolios"
\ No newline at end of file
+PORTFOLIO_STORAGE_DIR = "/Users/ben/portfolios"
+
+# market_api request scheduling. Calls to the market provider are limited to
+# MARKET_API_RATE_LIMIT per second, with bursts of up to MARKET_API_BURST.
+# Throttled calls are retried MARKET_API_MAX_RETRIES times, waiting about
+# MARKET_API_BACKOFF seconds before the first retry and doubling each time;
+# other errors are not retried. Callers waiting on an identical request that is
+# already running give up after MARKET_API_COALESCE_TIMEOUT seconds.
+MARKET_API_RATE_LIMIT = 2.0
+MARKET_API_BURST = 5
+MARKET_API_MAX_RETRIES = 3
+MARKET_API_BACKOFF = 1.0
+MARKET_API_COALESCE_TIMEOUT = 60.0
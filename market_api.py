@@ -2,39 +2,421 @@
 market_api.py
 
 Methods relating to getting data from the market (current price, etc.)
+
+All calls to the market go through a RequestScheduler, which coalesces
+identical in-flight requests, rate limits calls to the provider and retries
+throttled calls with backoff.
 """
 
 import yfinance as yf
 
 import datetime
+import random
+import threading
+import time
+
+from config import (MARKET_API_RATE_LIMIT, MARKET_API_BURST,
+                    MARKET_API_MAX_RETRIES, MARKET_API_BACKOFF,
+                    MARKET_API_COALESCE_TIMEOUT)
+
+
+class MarketAPIException(Exception):
+    """
+    Raised when a market request fails. The underlying error, if any, is the
+    __cause__.
+    """
+
+    def __init__(self, msg):
+        super().__init__(msg)
+        self.msg = msg
+
+    def __repr__(self):
+        return f"<MarketAPIException msg={self.msg}>"
+
+
+class ThrottledException(MarketAPIException):
+    """
+    Raised by a provider when it is refusing requests because we sent too many
+
+    This is the only error the scheduler retries.
+    """
+
+    def __repr__(self):
+        return f"<ThrottledException msg={self.msg}>"
+
+
+def _is_rate_limited(e):
+    """
+    Whether <e> is yfinance telling us to slow down (YFRateLimitError or 429)
+    """
+    rate_limit_error = getattr(getattr(yf, "exceptions", None),
+                               "YFRateLimitError", None)
+    if rate_limit_error is not None and isinstance(e, rate_limit_error):
+        return True
+    return getattr(getattr(e, "response", None), "status_code", None) == 429
+
+
+class YFinanceProvider:
+    """
+    Provider that gets market data from yfinance
+    """
+
+    def get_info(self, symbol: str):
+        try:
+            return yf.Ticker(symbol).info
+        except Exception as e:
+            if _is_rate_limited(e):
+                raise ThrottledException(
+                    f"yfinance rate limited info for {symbol}") from e
+            raise
+
+    def get_history(self, symbol: str, start, end):
+        try:
+            return yf.Ticker(symbol).history(start=start, end=end)
+        except Exception as e:
+            if _is_rate_limited(e):
+                raise ThrottledException(
+                    f"yfinance rate limited history for {symbol}") from e
+            raise
+
+
+class FakeProvider:
+    """
+    Local provider for exercising the scheduler without hitting the network
+
+    Every call sleeps for <latency> seconds. If more than <throttle_after>
+    calls arrive within <throttle_window> seconds, the call raises a
+    ThrottledException, like yfinance does when we burst too hard.
+    """
+
+    def __init__(self,
+                 info=None,
+                 history=None,
+                 latency=0.0,
+                 throttle_after=None,
+                 throttle_window=1.0):
+        self.info = {} if info is None else info
+        self.history = {} if history is None else history
+        self.latency = latency
+        self.throttle_after = throttle_after
+        self.throttle_window = throttle_window
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _call(self, symbol):
+        now = time.monotonic()
+        with self._lock:
+            recent = [
+                t for t in self.calls if now - t < self.throttle_window
+            ]
+            self.calls.append(now)
+        if self.throttle_after is not None and len(
+                recent) >= self.throttle_after:
+            raise ThrottledException(f"Too many requests for {symbol}")
+        time.sleep(self.latency)
+
+    def get_info(self, symbol: str):
+        self._call(symbol)
+        return self.info[symbol]
+
+    def get_history(self, symbol: str, start, end):
+        self._call(symbol)
+        return self.history[symbol]
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter
+
+    Holds up to <capacity> tokens and refills at <rate> tokens per second.
+    Each request takes one token, waiting for a refill if the bucket is empty.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1, got {capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, blocking until one is available
+
+        Return the number of seconds spent waiting
+        """
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return now - start
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class _InFlight:
+    """
+    A request that one caller is running on behalf of everyone asking for it
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestScheduler:
+    """
+    Schedules calls to the market provider
+
+    Identical requests (same key) that arrive while one is already running
+    share its result instead of making another call. Calls that do go out are
+    rate limited by a TokenBucket, and retried with jittered exponential
+    backoff while the provider is throttling us.
+
+    stats() reports:
+    - in_flight: requests currently being handled, running or waiting
+    - queue_depth: callers currently blocked, on the rate limiter or on a
+      coalesced request
+    - rate_limit_wait: time spent waiting for rate limiter tokens
+    - coalesced_wait: time spent waiting on someone else's request
+    - coalesce_timeouts: callers that gave up waiting on someone else's
+      request after coalesce_timeout seconds
+    - latency: time from submit() to return, including provider time and
+      backoff
+    """
+
+    def __init__(self,
+                 rate: float = MARKET_API_RATE_LIMIT,
+                 burst: int = MARKET_API_BURST,
+                 max_retries: int = MARKET_API_MAX_RETRIES,
+                 backoff: float = MARKET_API_BACKOFF,
+                 coalesce_timeout: float = MARKET_API_COALESCE_TIMEOUT):
+        if max_retries < 0:
+            raise ValueError(
+                f"max_retries must not be negative, got {max_retries}")
+        if coalesce_timeout is not None and coalesce_timeout <= 0:
+            raise ValueError(
+                f"coalesce_timeout must be positive, got {coalesce_timeout}")
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.coalesce_timeout = coalesce_timeout
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.queue_depth = 0
+            self.max_queue_depth = 0
+            self.requests = 0
+            self.coalesced = 0
+            self.calls = 0
+            self.retries = 0
+            self.failures = 0
+            self.coalesce_timeouts = 0
+            self.total_rate_limit_wait = 0
+            self.max_rate_limit_wait = 0
+            self.total_coalesced_wait = 0
+            self.max_coalesced_wait = 0
+            self.total_latency = 0
+            self.max_latency = 0
+
+    def stats(self):
+        """
+        Return a dict of queue depth, wait time and request counters
+        """
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "requests": self.requests,
+                "coalesced": self.coalesced,
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "coalesce_timeouts": self.coalesce_timeouts,
+                "total_rate_limit_wait": self.total_rate_limit_wait,
+                "max_rate_limit_wait": self.max_rate_limit_wait,
+                "mean_rate_limit_wait":
+                self.total_rate_limit_wait / self.calls if self.calls else 0,
+                "total_coalesced_wait": self.total_coalesced_wait,
+                "max_coalesced_wait": self.max_coalesced_wait,
+                "total_latency": self.total_latency,
+                "max_latency": self.max_latency,
+                "mean_latency":
+                self.total_latency / self.requests if self.requests else 0
+            }
+
+    def _enter_queue(self):
+        with self._lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth,
+                                       self.queue_depth)
+
+    def _leave_queue(self):
+        with self._lock:
+            self.queue_depth -= 1
+
+    def submit(self, key, fn):
+        """
+        Run <fn> for <key>, or wait on the identical request already running
+
+        Return the result of <fn>. Everyone coalesced onto a request gets the
+        same result object, so callers must not mutate it.
+
+        If <fn> fails, every caller gets its own MarketAPIException with the
+        original error as its __cause__. So does a caller that waits more than
+        coalesce_timeout seconds on someone else's request.
+        """
+        start = time.monotonic()
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = _InFlight()
+                self._in_flight[key] = in_flight
+            else:
+                self.coalesced += 1
+
+        try:
+            if leader:
+                try:
+                    in_flight.result = self._call(fn)
+                except BaseException as e:
+                    in_flight.error = e
+                    with self._lock:
+                        self.failures += 1
+                    if not isinstance(e, Exception):
+                        # Don't swallow KeyboardInterrupt and friends
+                        raise
+                finally:
+                    with self._lock:
+                        del self._in_flight[key]
+                    in_flight.done.set()
+            else:
+                self._enter_queue()
+                try:
+                    finished = in_flight.done.wait(self.coalesce_timeout)
+                finally:
+                    self._leave_queue()
+                    waited = time.monotonic() - start
+                    with self._lock:
+                        self.total_coalesced_wait += waited
+                        self.max_coalesced_wait = max(self.max_coalesced_wait,
+                                                      waited)
+                if not finished:
+                    with self._lock:
+                        self.coalesce_timeouts += 1
+                    raise MarketAPIException(
+                        f"Timed out after {self.coalesce_timeout}s waiting "
+                        f"on request {key}")
+            if in_flight.error is not None:
+                raise MarketAPIException(
+                    f"Request {key} failed: {in_flight.error!r}"
+                ) from in_flight.error
+            return in_flight.result
+        finally:
+            latency = time.monotonic() - start
+            with self._lock:
+                self.in_flight -= 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def _call(self, fn):
+        """
+        Call <fn> once a token is available, retrying with backoff while the
+        provider is throttling us. Any other error, or the last
+        ThrottledException once we run out of retries, is raised as is.
+        """
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                with self._lock:
+                    self.retries += 1
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay *= 2
+            self._enter_queue()
+            try:
+                waited = self.bucket.acquire()
+            finally:
+                self._leave_queue()
+            with self._lock:
+                self.calls += 1
+                self.total_rate_limit_wait += waited
+                self.max_rate_limit_wait = max(self.max_rate_limit_wait,
+                                               waited)
+            try:
+                return fn()
+            except ThrottledException:
+                if attempt == self.max_retries:
+                    raise
+
+
+provider = YFinanceProvider()
+scheduler = RequestScheduler()
+
+
+def set_provider(new_provider):
+    """
+    Swap out where market data comes from (e.g. for a FakeProvider)
+    """
+    global provider
+    provider = new_provider
+
+
+def _get_info(symbol: str):
+    return scheduler.submit(("info", symbol),
+                            lambda: provider.get_info(symbol))
+
+
+def _get_history(symbol: str, start, end):
+    return scheduler.submit(("history", symbol, start, end),
+                            lambda: provider.get_history(symbol, start, end))
 
 
 def get_current_price(symbol: str):
     """
     Get the current price of a whatever identified by a symbol
     """
-    obj = yf.Ticker(symbol)
-    return obj.info["currentPrice"]
+    return _get_info(symbol)["currentPrice"]
 
 
 def get_last_dividend_date(symbol: str):
     """
     Get the last date that a dividend was exercised
     """
-    obj = yf.Ticker(symbol)
-    return datetime.date.fromtimestamp(obj.info["lastDividendDate"])
+    return datetime.date.fromtimestamp(_get_info(symbol)["lastDividendDate"])
 
 
 def get_last_dividend_value(symbol: str):
     """
     Get the value of the last dividend, measured in number of shares
     """
-    obj = yf.Ticker(symbol)
-    last_dividend_date = datetime.date.fromtimestamp(
-        obj.info["lastDividendDate"])
+    info = _get_info(symbol)
+    last_dividend_date = datetime.date.fromtimestamp(info["lastDividendDate"])
     next_week = datetime.date.fromtimestamp(
-        (obj.info["lastDividendDate"] + (24 * 3600 * 7)))
-    history = obj.history(start=last_dividend_date, end=next_week)
+        (info["lastDividendDate"] + (24 * 3600 * 7)))
+    history = _get_history(symbol, last_dividend_date, next_week)
     share_price = history.iloc[0]["Close"]
-    dividend_cash_value = obj.info["lastDividendDate"]
+    dividend_cash_value = info["lastDividendDate"]
     return (dividend_cash_value / share_price)
+
@@ -0,0 +1,237 @@
+"""
+test_market_api.py
+
+Tests for the market_api request scheduler, run against a FakeProvider so
+they never touch the network.
+"""
+
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import market_api
+from market_api import (FakeProvider, MarketAPIException, RequestScheduler,
+                        ThrottledException, TokenBucket, YFinanceProvider)
+
+PRICES = {s: {"currentPrice": i + 1} for i, s in enumerate("ABCDEF")}
+
+
+def run_concurrently(symbols):
+    """
+    Call get_current_price for each symbol in its own thread
+
+    Return (results, errors), both dicts keyed by index into <symbols>
+    """
+    results = {}
+    errors = {}
+
+    def worker(i, symbol):
+        try:
+            results[i] = market_api.get_current_price(symbol)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [
+        threading.Thread(target=worker, args=(i, symbol))
+        for i, symbol in enumerate(symbols)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+class SchedulerTestCase(unittest.TestCase):
+    """
+    Gives each test its own scheduler and provider, and puts the module-level
+    ones back afterwards
+    """
+
+    def use(self, provider, **scheduler_args):
+        scheduler_args.setdefault("rate", 100)
+        scheduler_args.setdefault("burst", 10)
+        scheduler = RequestScheduler(**scheduler_args)
+        for name, value in (("provider", provider), ("scheduler", scheduler)):
+            patcher = mock.patch.object(market_api, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return scheduler
+
+
+class TestCoalescing(SchedulerTestCase):
+
+    def test_concurrent_same_symbol_shares_one_call(self):
+        fake = FakeProvider(info=PRICES, latency=0.2)
+        scheduler = self.use(fake)
+        results, errors = run_concurrently(["A"] * 8)
+        stats = scheduler.stats()
+        self.assertEqual(errors, {})
+        self.assertEqual(set(results.values()), {1})
+        self.assertEqual(len(fake.calls), 1)
+        self.assertEqual(stats["calls"], 1)
+        self.assertEqual(stats["coalesced"], 7)
+        self.assertGreater(stats["max_coalesced_wait"], 0)
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_coalesce_timeout(self):
+        fake = FakeProvider(info=PRICES, latency=0.5)
+        scheduler = self.use(fake, coalesce_timeout=0.05)
+        results, errors = run_concurrently(["A"] * 3)
+        self.assertEqual(list(results.values()), [1])
+        self.assertEqual(len(errors), 2)
+        for e in errors.values():
+            self.assertIsInstance(e, MarketAPIException)
+        self.assertEqual(scheduler.stats()["coalesce_timeouts"], 2)
+
+    def test_interrupted_leader_fails_followers(self):
+        scheduler = RequestScheduler(rate=100, burst=10)
+        started = threading.Event()
+        release = threading.Event()
+        outcomes = []
+
+        def interrupted():
+            started.set()
+            release.wait()
+            raise KeyboardInterrupt
+
+        def leader():
+            try:
+                scheduler.submit("k", interrupted)
+            except KeyboardInterrupt as e:
+                outcomes.append(e)
+
+        def follower():
+            try:
+                outcomes.append(scheduler.submit("k", lambda: 1))
+            except MarketAPIException as e:
+                outcomes.append(e)
+
+        threads = [threading.Thread(target=leader)]
+        threads[0].start()
+        started.wait()
+        threads += [threading.Thread(target=follower) for _ in range(2)]
+        for thread in threads[1:]:
+            thread.start()
+        while scheduler.stats()["coalesced"] < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(
+            sum(isinstance(o, KeyboardInterrupt) for o in outcomes), 1)
+        followers = [o for o in outcomes if isinstance(o, MarketAPIException)]
+        self.assertEqual(len(followers), 2)
+        for e in followers:
+            self.assertIsInstance(e.__cause__, KeyboardInterrupt)
+
+
+class TestRateLimit(SchedulerTestCase):
+
+    def test_calls_are_spaced_once_burst_is_used(self):
+        fake = FakeProvider(info=PRICES)
+        scheduler = self.use(fake, rate=10, burst=1)
+        results, errors = run_concurrently("ABCDE")
+        stats = scheduler.stats()
+        self.assertEqual(errors, {})
+        # 4 calls after the burst, at 10 per second
+        self.assertGreaterEqual(fake.calls[-1] - fake.calls[0], 0.3)
+        self.assertGreaterEqual(stats["max_rate_limit_wait"], 0.3)
+        self.assertGreaterEqual(stats["max_queue_depth"], 2)
+
+    def test_token_bucket_rejects_bad_config(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0, capacity=1)
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=1, capacity=0)
+
+    def test_scheduler_rejects_bad_config(self):
+        with self.assertRaises(ValueError):
+            RequestScheduler(max_retries=-1)
+        with self.assertRaises(ValueError):
+            RequestScheduler(coalesce_timeout=0)
+
+
+class TestRetry(SchedulerTestCase):
+
+    def test_throttled_burst_recovers(self):
+        fake = FakeProvider(info=PRICES, throttle_after=2, throttle_window=0.5)
+        scheduler = self.use(fake, max_retries=6, backoff=0.2)
+        results, errors = run_concurrently("ABCDEF")
+        stats = scheduler.stats()
+        self.assertEqual(errors, {})
+        self.assertEqual(sorted(results.values()), [1, 2, 3, 4, 5, 6])
+        self.assertGreater(stats["retries"], 0)
+        self.assertEqual(stats["failures"], 0)
+
+    def test_permanent_error_is_not_retried(self):
+        fake = FakeProvider(info=PRICES, latency=0.2)
+        scheduler = self.use(fake)
+        results, errors = run_concurrently(["missing"] * 3)
+        stats = scheduler.stats()
+        self.assertEqual(len(fake.calls), 1)
+        self.assertEqual(stats["retries"], 0)
+        self.assertEqual(len(errors), 3)
+        for e in errors.values():
+            self.assertIsInstance(e, MarketAPIException)
+            self.assertIsInstance(e.__cause__, KeyError)
+
+    def test_gives_up_after_max_retries(self):
+        fake = FakeProvider(info=PRICES, throttle_after=0)
+        scheduler = self.use(fake, max_retries=2, backoff=0.01)
+        with self.assertRaises(MarketAPIException) as cm:
+            market_api.get_current_price("A")
+        self.assertIsInstance(cm.exception.__cause__, ThrottledException)
+        self.assertEqual(len(fake.calls), 3)
+        self.assertEqual(scheduler.stats()["retries"], 2)
+
+
+class TestYFinanceProvider(unittest.TestCase):
+
+    def patch_ticker(self, error):
+
+        class Ticker:
+
+            def __init__(self, symbol):
+                pass
+
+            @property
+            def info(self):
+                raise error
+
+        patcher = mock.patch.object(market_api.yf, "Ticker", Ticker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rate_limit_error_is_throttled(self):
+        rate_limit_error = type("YFRateLimitError", (Exception, ), {})
+        patcher = mock.patch.object(
+            market_api.yf,
+            "exceptions",
+            types.SimpleNamespace(YFRateLimitError=rate_limit_error),
+            create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.patch_ticker(rate_limit_error())
+        with self.assertRaises(ThrottledException):
+            YFinanceProvider().get_info("A")
+
+    def test_http_429_is_throttled(self):
+        error = Exception("Too Many Requests")
+        error.response = types.SimpleNamespace(status_code=429)
+        self.patch_ticker(error)
+        with self.assertRaises(ThrottledException):
+            YFinanceProvider().get_info("A")
+
+    def test_other_errors_pass_through(self):
+        self.patch_ticker(ValueError("bad ticker"))
+        with self.assertRaises(ValueError):
+            YFinanceProvider().get_info("A")
+
+
+if __name__ == "__main__":
+    unittest.main()